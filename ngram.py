@@ -2,47 +2,125 @@ from numpy import dot
 from math import sqrt
 from numpy import mean
 import numpy as np
+from scipy.sparse import csr_matrix
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count, shared_memory
 import csv_reader
 import sys
 
+try:
+    import cupy
+    from cupyx.scipy.sparse import csr_matrix as gpu_csr_matrix
+    # cupy can be installed without a usable gpu, fall back to the cpu then
+    if cupy.cuda.runtime.getDeviceCount() == 0:
+        cupy = None
+except Exception:
+    cupy = None
 
-def n_gram(text, n):
-    """Returns a generator for all n-grams of the text"""
-    grams = (zip(*[text[i:] for i in range(n)]))
-    return grams
+
+# bits per word in an integer gram key, three words fit in an uint64
+WORD_BITS = 21
 
 
-def all_grams(text, n=3):
-    """Returns a list of all n-grams up to n based on text, by default n is 3"""
+def all_grams(word_ids):
+    """
+    Returns a list of integer keys for all 1-, 2- and 3-grams of the word ids, made in a single pass.
+    Each word of a gram takes WORD_BITS bits of the key, offset by one so that grams of different length never collide
+    """
     grams = []
-    for i in range(n):
-        grams.extend(n_gram(text, i+1))
+    append = grams.append
+    # keys of the unigram and bigram ending at the previous word, 0 before there is one
+    unigram = bigram = 0
+    for word in word_ids:
+        word += 1
+        append(word)
+        if bigram:
+            append((bigram << WORD_BITS) | word)
+        if unigram:
+            bigram = (unigram << WORD_BITS) | word
+            append(bigram)
+        unigram = word
     return grams
 
 
-def build_index_table(words):
+def build_word_table(words):
     """
     :param words: list of words
-    :return dictionary giving each word a unique index
+    :return dictionary giving each distinct word a unique integer id
     """
-    grams = set(all_grams(words))
     table = {}
-    for index, gram in enumerate(grams):
-        table[gram] = index
+    for word in words:
+        if word not in table:
+            table[word] = len(table)
+    assert len(table) < 1 << WORD_BITS, "too many distinct words for the gram keys"
     return table
 
 
-def build_title_vector(table, words):
+def encode(word_table, words):
+    """
+    :param word_table: dictionary from build_word_table
+    :param words: list of words
+    :return: int32 array with the id of each word
+    """
+    return np.fromiter((word_table[word] for word in words), dtype=np.int32, count=len(words))
+
+
+def build_index_table(titles):
+    """
+    :param titles: list of arrays of word ids from encode, one per title
+    :return sorted uint64 array of every integer gram key, the index of a gram is its position in the array,
+    grams never span two titles
+    """
+    grams = set()
+    for word_ids in titles:
+        grams.update(all_grams(word_ids.tolist()))
+    return np.sort(np.fromiter(grams, dtype=np.uint64, count=len(grams)))
+
+
+def gram_indices(table, word_ids):
+    """
+    :param table: sorted array of gram keys from build_index_table
+    :param word_ids: array of word ids from encode to build the n-grams from
+    :return: int32 array with the index of every gram of the words, grams not in the table are left out
+    """
+    keys = np.array(all_grams(word_ids.tolist()), dtype=np.uint64)
+    positions = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+    return positions[table[positions] == keys].astype(np.int32)
+
+
+def build_title_vector(table, word_ids):
+    """
+    :param table: sorted array of gram keys from build_index_table
+    :param word_ids: array of word ids from encode to build the n-grams from
+    :return: sparse n-gram vector for the words as a tuple of the nonzero indices and their counts
+    """
+    indices, values = np.unique(gram_indices(table, word_ids), return_counts=True)
+    return indices, values.astype(np.int32)
+
+
+def build_category_vector(table, titles):
+    """
+    Sums the n-gram vectors of many titles, counting with np.bincount which is faster than build_title_vector for
+    the many grams of a user. Grams are taken per title, so no gram spans two titles
+    :param table: sorted array of gram keys from build_index_table
+    :param titles: list of arrays of word ids from encode, one per title
+    :return: sparse n-gram vector for the titles as a tuple of the nonzero indices and their counts
+    """
+    grams = np.concatenate([gram_indices(table, word_ids) for word_ids in titles] + [np.zeros(0, dtype=np.int32)])
+    counts = np.bincount(grams, minlength=len(table))
+    indices = np.flatnonzero(counts).astype(np.int32)
+    return indices, counts[indices].astype(np.int32)
+
+
+def dense_vector(title_vector, size):
     """
-    :param table: dictionary
-    :param words: list of words to build the n-grams from
-    :return: n-gram vector for the words
+    :param title_vector: sparse vector as a tuple of indices and counts from build_title_vector
+    :param size: length of the dense vector, the size of the gram index table
+    :return: the dense version of the vector
     """
-    grams = all_grams(words)
-    vector = [0]*len(table)
-    for gram in grams:
-        index = table[gram]
-        vector[index] += 1
+    indices, values = title_vector
+    vector = np.zeros(size, dtype=np.int32)
+    vector[indices] = values
     return vector
 
 
@@ -52,80 +130,246 @@ def cosine_similarity(category_vector, title_vector):
     :param title_vector: title vector
     :return: cosine distance between the two given vectors
     """
-    inner = dot(category_vector, title_vector)
-    dist_category = sqrt(sum(map(lambda x: x**2, category_vector)))
-    dist_title = sqrt(sum(map(lambda x: x**2, title_vector)))
-
-    cosine = inner / (dist_category*dist_title)
-    return cosine
+    category_vector = np.asarray(category_vector, dtype=np.int32)
+    title_vector = np.asarray(title_vector, dtype=np.int32)
+    denom = sqrt(float(np.vdot(category_vector, category_vector)) * float(np.vdot(title_vector, title_vector)))
+    return float(dot(category_vector, title_vector)) / denom
 
 
 def euclidean_distance(categoty_vector, title_vector):
     return sqrt(sum(map(lambda x: (x[0]-x[1])**2, zip(categoty_vector, title_vector))))
 
 
-def all_measures(measure_function, category_vector_table, title_vector):
+def all_measures(measure_function, users, category_matrix, title_vector):
     """
-    :param category_vector_table: dictionary mapping each user to their category vector
+    :param users: array of users, one per row of category_matrix
+    :param category_matrix: matrix with the category vector of each user as rows
     :param title_vector: vector to compare against
-    :return: list of tuples of user and cosine between the title_vector and that users category vector
+    :return: list of tuples of measure between the title_vector and that users category vector, and user
     """
-    results = [None]*len(category_vector_table.keys())
-    for index, user in enumerate(category_vector_table.keys()):
-        res = measure_function(category_vector_table[user], title_vector)
-        results[index] = (res, user)
-    return results
+    return [(measure_function(vector, title_vector), user) for user, vector in zip(users, category_matrix)]
 
 
-def classify(measure_function, category_vector_table, title_vector, predicate=lambda x: [max(x)]):
+def all_cosines(normalized_matrix_t, title_vector):
     """
-    :param category_vector_table: dictionary mapping each user to their category vector
-    :param title_vector: vector to compare against
-    :param predicate: function that takes a list of cosine, user tuples return which ones to recommend
-    :return: predicate function applied with the list of cosine,user tuples
+    Computes the cosine against every category vector at once with a single matrix-vector product
+    :param normalized_matrix_t: matrix with the L2 normalized category vector of each user as columns
+    :param title_vector: sparse vector from build_title_vector to compare against
+    :return: array with the cosine between the title_vector and each users category vector
     """
-    measures = all_measures(measure_function, category_vector_table,title_vector)
-    return predicate(measures)
+    indices, values = title_vector
+    values = values.astype(np.float32)
+    values /= np.sqrt(values @ values) + 1e-12
+    # only the rows where the title has a gram contribute to the dot product
+    return values @ normalized_matrix_t[indices]
 
 
-def user_titles_table(raw_titles, raw_users):
+def title_matrix(title_vectors, size):
     """
-    :param raw_titles: list of titles from csv_reader
-    :param raw_users: list of users from csv_reader
-    :return: dictionary from users to a single long title (all their titles concatenated)
+    :param title_vectors: list of sparse vectors from build_title_vector
+    :param size: number of columns, the size of the gram index table
+    :return: sparse matrix with the (not normalized) title vectors as rows
     """
-    table = {}
-    for title, users in zip(raw_titles, raw_users):
-        for user in users.split():
-            if user not in table:
-                table[user] = []
-            table[user].append(title)
+    indptr = np.zeros(len(title_vectors) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(indices) for indices, _ in title_vectors])
+    indices = np.concatenate([indices for indices, _ in title_vectors] + [np.zeros(0, dtype=np.int32)])
+    data = np.concatenate([values for _, values in title_vectors] + [np.zeros(0)]).astype(np.float32)
+    return csr_matrix((data, indices, indptr), shape=(len(title_vectors), size))
+
+
+def all_scores_matrix(normalized_matrix_t, titles_matrix):
+    """
+    Computes the score between every title and every category vector with a single matrix product. A score is the
+    cosine multiplied by the norm of the title, so it ranks the users of one title like the cosine does but is not
+    bounded by 1 and can not be compared across titles
+    :param normalized_matrix_t: C-contiguous matrix with the L2 normalized category vector of each user as columns,
+    either a numpy array or a cupy array already on the gpu
+    :param titles_matrix: sparse matrix from title_matrix
+    :return: array with the scores of each title as rows and one column per user
+    """
+    if cupy is not None and isinstance(normalized_matrix_t, cupy.ndarray):
+        # the titles go to the gpu as a sparse matrix, dense they would not fit for a big vocabulary
+        return cupy.asnumpy(gpu_csr_matrix(titles_matrix) @ normalized_matrix_t)
+    # scipy multiplies a C-contiguous dense matrix in place, a transposed view would be copied whole on every call
+    return np.asarray(titles_matrix @ normalized_matrix_t)
+
+
+def top_k(scores, users, k):
+    """
+    :param scores: array of cosines (or scores from all_scores_matrix), one per user
+    :param users: array of users
+    :param k: number of users to return
+    :return: list of the k best users, best first
+    """
+    split = max(len(scores) - k, 0)
+    best = np.argpartition(scores, split)[split:]
+    return users[best[np.argsort(-scores[best])]].tolist()
+
+
+def top2(scores, users):
+    """
+    :param scores: array of cosines (or scores from all_scores_matrix), one per user
+    :param users: array of users
+    :return: list of the two best users, best first
+    """
+    return top_k(scores, users, 2)
+
+
+def top1(scores, users):
+    """
+    :param scores: array of cosines (or scores from all_scores_matrix), one per user
+    :param users: array of users
+    :return: list with the best user
+    """
+    return top_k(scores, users, 1)
+
+
+def classify(category_table, title_vector, predicate=top1):
+    """
+    :param category_table: tuple of users and (grams, users) normalized category matrix from make_category_table
+    :param title_vector: sparse vector from build_title_vector to compare against
+    :param predicate: function that takes the array of cosines and the array of users return which users to recommend
+    :return: predicate function applied with the cosines and users, no users for a title without any grams
+    """
+    users, normalized_matrix_t = category_table
+    if len(title_vector[0]) == 0:
+        # the cosine is undefined for an empty title (such as one that was only punctuation), recommend no one
+        return []
+    cosines = all_cosines(normalized_matrix_t, title_vector)
+    return predicate(cosines, users)
+
+
+def classify_chunk(normalized_matrix_t, users, title_vectors, predicate):
+    """
+    :param normalized_matrix_t: C-contiguous matrix with the L2 normalized category vector of each user as columns
+    :param users: array of users, one per column of normalized_matrix_t
+    :param title_vectors: list of sparse vectors from build_title_vector to compare against
+    :param predicate: function that takes the array of scores and the array of users return which users to recommend,
+    it must only compare the scores of one title against each other
+    :return: list with the predicate function applied with the scores and users for each title, no users for a
+    title without any grams
+    """
+    # the title norm scales all cosines of a title by the same positive constant, which does not change the users
+    # a predicate picks, so the titles are not normalized and the predicates get scores rather than cosines
+    scores = all_scores_matrix(normalized_matrix_t, title_matrix(title_vectors, normalized_matrix_t.shape[0]))
+    # the cosine is undefined for an empty title (such as one that was only punctuation), recommend no one
+    return [predicate(title_scores, users) if len(indices) else []
+            for title_scores, (indices, _) in zip(scores, title_vectors)]
+
+
+# category table of a worker process, attached to the shared memory by attach_categories
+worker_categories = None
+
+
+def attach_categories(shm_name, shape, dtype, users):
+    """Pool initializer, maps the normalized category matrix in shared memory without copying it"""
+    global worker_categories
+    shm = shared_memory.SharedMemory(name=shm_name)
+    worker_categories = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf), users)
+
+
+def classify_shared_chunk(chunk):
+    """Classifies a chunk of title vectors against the category matrix of attach_categories"""
+    title_vectors, predicate = chunk
+    _, normalized_matrix_t, users = worker_categories
+    return classify_chunk(normalized_matrix_t, users, title_vectors, predicate)
 
-    for key in table.keys():
-        table[key] = " ".join(table[key])
 
+def unique_title_vectors(title_vectors):
+    """
+    :param title_vectors: list of sparse vectors from build_title_vector
+    :return: tuple of the list of distinct title vectors and, for each given title vector, its position in that list
+    """
+    positions = {}
+    unique_vectors = []
+    rows = []
+    for indices, values in title_vectors:
+        key = (indices.tobytes(), values.tobytes())
+        if key not in positions:
+            positions[key] = len(unique_vectors)
+            unique_vectors.append((indices, values))
+        rows.append(positions[key])
+    return unique_vectors, rows
+
+
+def classify_all(category_table, title_vectors, predicate=top1, processes=None):
+    """
+    :param category_table: tuple of users and (grams, users) normalized category matrix from make_category_table
+    :param title_vectors: list of sparse vectors from build_title_vector to compare against
+    :param predicate: function that takes the array of scores (see all_scores_matrix) and the array of users return
+    which users to recommend, must be picklable (a module level function) when more than one process is used
+    :param processes: number of worker processes to split the titles over, by default one per cpu. When cupy is
+    installed and a gpu is available the product runs on the gpu in this process and no pool is started
+    :return: list with the predicate function applied with the scores and users for each title
+    """
+    users, normalized_matrix_t = category_table
+    # classification is pure, so every distinct title vector only needs to be classified once
+    title_vectors, title_rows = unique_title_vectors(title_vectors)
+
+    processes = min(processes or cpu_count(), len(title_vectors))
+    if cupy is not None:
+        # the category matrix is copied to the gpu once and reused for the whole product
+        predictions = classify_chunk(cupy.asarray(normalized_matrix_t), users, title_vectors, predicate)
+    elif processes <= 1:
+        predictions = classify_chunk(normalized_matrix_t, users, title_vectors, predicate)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=normalized_matrix_t.nbytes)
+        try:
+            shared = np.ndarray(normalized_matrix_t.shape, dtype=normalized_matrix_t.dtype, buffer=shm.buf)
+            shared[:] = normalized_matrix_t
+            del shared
+            bounds = np.linspace(0, len(title_vectors), processes + 1).astype(int)
+            chunks = [(title_vectors[start:end], predicate) for start, end in zip(bounds[:-1], bounds[1:])]
+            initargs = (shm.name, normalized_matrix_t.shape, normalized_matrix_t.dtype, users)
+            with Pool(processes, initializer=attach_categories, initargs=initargs) as pool:
+                results = pool.map(classify_shared_chunk, chunks)
+        finally:
+            shm.close()
+            shm.unlink()
+        predictions = [title_predictions for chunk in results for title_predictions in chunk]
+    return [predictions[row] for row in title_rows]
+
+
+def user_titles_table(titles, raw_users):
+    """
+    :param titles: list of arrays of word ids from encode, one per title from csv_reader
+    :param raw_users: list of users from csv_reader
+    :return: dictionary from users to a list with the word ids of each of their titles
+    """
+    table = defaultdict(list)
+    for word_ids, users in zip(titles, raw_users):
+        for user in users.split():
+            table[user].append(word_ids)
     return table
 
 
 def make_category_table(grams_index_table, user_title_table):
     """
-    :param grams_index_table: dictionary mapping gram to index
-    :param user_title_table: dictionary mapping user to a single long title (all their titles concatenated)
-    :return: dictionary mapping user to their category vector
+    :param grams_index_table: sorted array of gram keys from build_index_table
+    :param user_title_table: dictionary mapping user to a list with the word ids of each of their titles
+    :return: tuple of array of users and float32 matrix with each users L2 normalized category vector as columns, so
+    that cosine against a normalized title vector is a plain dot product. The matrix is stored as (grams, users) so
+    that a product with sparse title rows reads it in place
     """
-    table = {}
-    for user in user_title_table.keys():
-        table[user] = build_title_vector(grams_index_table, user_title_table[user].split())
-    return table
+    users = []
+    vectors = []
+    for user, user_titles in user_title_table.items():
+        users.append(user)
+        vectors.append(build_category_vector(grams_index_table, user_titles))
+    # the raw counts are only needed to normalize, so they go straight into the float32 matrix used for the cosines
+    normalized_matrix_t = np.zeros((len(grams_index_table), len(users)), dtype=np.float32)
+    for column, (indices, values) in enumerate(vectors):
+        normalized_matrix_t[indices, column] = values / (sqrt(int(values @ values)) + 1e-12)
+    return np.array(users), normalized_matrix_t
 
 
 def read(file_path):
     "titles, users"
     return csv_reader.CsvReader().get_data(file_path, label_column=2)
 
-def allAboveMean(x):
-	m = sum([k[0] for k in x])/len(x)
-	res = [item for item in x if (item[0]) >= m]	
+def allAboveMean(scores, users):
+	m = scores.mean(dtype=np.float64)
+	res = users[scores >= m].tolist()
 	return res
 
 def print_stats(true_positive, true_negative, false_negative, false_positive, total):
@@ -144,31 +388,29 @@ if __name__ == "__main__":
     path = "data/validation_data_top_5_subreddit_allvotes.csv"
     val_titles, val_users = read(path)
 
-    user2full_title = user_titles_table(titles, users)
-    user2full_title_val = user_titles_table(val_titles, val_users)
-    print("number of users {0}".format(len(user2full_title_val)))
-    #print(user2full_title_val)
+    print("number of users {0}".format(len({user for users in val_users for user in users.split()})))
 
-    # Don't need these anymore
-    del titles
-    del users
-
-    # Big index table needs all grams (validation and training)
-    words = []
-    for user in user2full_title.keys():
-        words.extend(user2full_title[user].split())
-
-    for user in user2full_title_val.keys():
-        words.extend(user2full_title_val[user].split())
+    # Split and encode every title once, the encodings are reused for the categories and the title vectors
+    split_titles = [title.split() for title in titles]
+    split_val_titles = [title.split() for title in val_titles]
+    word_table = build_word_table([word for words in split_titles + split_val_titles for word in words])
+    train_tokens = [encode(word_table, words) for words in split_titles]
+    val_tokens = [encode(word_table, words) for words in split_val_titles]
+    del split_titles
+    del split_val_titles
 
-    all_grams_index_table = build_index_table(words)
-
-    del words
+    # Big index table needs all grams (validation and training), taken per title so no gram spans two titles
+    all_grams_index_table = build_index_table(train_tokens + val_tokens)
 
     # categories are based on the training data
-    categories = make_category_table(all_grams_index_table, user2full_title)
+    user2titles = user_titles_table(train_tokens, users)
+    categories = make_category_table(all_grams_index_table, user2titles)
 
-    del user2full_title
+    # Don't need these anymore
+    del titles
+    del users
+    del train_tokens
+    del user2titles
 
     true_positive = 0
     true_negative = 0
@@ -177,35 +419,34 @@ if __name__ == "__main__":
 
     count = 0
 
-    def top2(x):
-        x1 = max(x)
-        x2 = max(set(x)-set(x1))
-        return [x1, x2]
-
+    val_users_set = set(val_users)
+    n_val_users = len(val_users_set)
 
+    title_vectors = [build_title_vector(all_grams_index_table, word_ids) for word_ids in val_tokens]
 
+    # only the category matrices and title vectors are needed from here on
+    del all_grams_index_table
+    del word_table
+    del val_tokens
 
-    for title, users in zip(val_titles, val_users):
-        title_vector = build_title_vector(all_grams_index_table, title.split())
-        predictions = classify(cosine_similarity, categories, title_vector, predicate=allAboveMean)
-        #predictions = classify(euclidean_distance, categories, title_vector, predicate=lambda x: [min(x)])
-        predictions = list(map(lambda x: x[1], predictions))
+    # one sparse product for all titles, on par with classify per title for thousands of users and about twice as
+    # fast for the few users of these data sets, and it is where the deduplication, the pool and the gpu come in
+    all_predictions = classify_all(categories, title_vectors, predicate=allAboveMean)
 
+    for predictions, users in zip(all_predictions, val_users):
+        # users that were not predicted, without building the set difference
+        not_predicted = n_val_users - len(val_users_set.intersection(predictions))
         for user in users.split():
-            for prediction in predictions:
-                if prediction == user:
-                    # should recommend, did recommend
-                    true_positive += 1
-                else:
-                    # should not recommend, did recommend
-                    false_positive += 1
-            for not_prediction in set(val_users) - set(predictions):
-                if not_prediction == user:
-                    # should recommend, did not recommend
-                    false_negative += 1
-                else:
-                    # should not recommend, did not recommend
-                    true_negative += 1
+            hits = predictions.count(user)
+            # should recommend, did recommend
+            true_positive += hits
+            # should not recommend, did recommend
+            false_positive += len(predictions) - hits
+            missed = int(user in val_users_set and user not in predictions)
+            # should recommend, did not recommend
+            false_negative += missed
+            # should not recommend, did not recommend
+            true_negative += not_predicted - missed
 
         count += 1
         if count % 50 == 0: